@@ -1,9 +1,12 @@
 import csv
 import datetime as dt
+import functools
 import re
 from io import StringIO
 
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import IntegrityError, models, transaction
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 import numpy as np
@@ -14,6 +17,24 @@ from enhydris.models import Timeseries, TimeseriesGroup
 
 from . import tasks
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _get_writeable_array(series, dtype=None):
+    """Return the values of a series as an ndarray that may be modified.
+
+    The underlying array is returned without copying if possible; it is copied only
+    if it needs dtype conversion or if pandas provides it read-only (as it does with
+    copy-on-write).
+    """
+    result = series.to_numpy(dtype=dtype, copy=False)
+    if not result.flags.writeable:
+        result = result.copy()
+    return result
+
 
 class AutoProcess(models.Model):
     timeseries_group = models.ForeignKey(TimeseriesGroup, on_delete=models.CASCADE)
@@ -42,14 +63,23 @@ class AutoProcess(models.Model):
         AutoProcess object and there exists a related Checks object, this is accessible
         as auto_process.checks. So by checking whether the auto_process object ("self"
         in this case) has a "checks" (or "curveinterpolation", or "aggregation")
-        attribute, we can figure out what the actual subclass is.
+        attribute, we can figure out what the actual subclass is. Once found, the
+        subclass object is cached on the instance, so that subsequent accesses don't
+        need to go through the alternatives again.
         """
-        for alternative in ("checks", "curveinterpolation", "aggregation"):
-            if hasattr(self, alternative):
-                result = getattr(self, alternative)
-                if hasattr(self, "htimeseries"):
-                    result.htimeseries = self.htimeseries
-                return result
+        if "_subclass_cache" not in self.__dict__:
+            for alternative in ("checks", "curveinterpolation", "aggregation"):
+                try:
+                    self._subclass_cache = getattr(self, alternative)
+                except ObjectDoesNotExist:
+                    continue
+                break
+            else:
+                return None
+        result = self._subclass_cache
+        if hasattr(self, "htimeseries"):
+            result.htimeseries = self.htimeseries
+        return result
 
     def _get_start_date(self):
         start_date = self._subclass.target_timeseries.end_date
@@ -99,14 +129,72 @@ class Checks(AutoProcess):
         for check_type in (RangeCheck,):
             try:
                 check = check_type.objects.get(checks=self)
-                check.htimeseries = self.htimeseries
-                check.check_timeseries()
-                self.htimeseries = check.htimeseries
-            except check.DoesNotExist:
-                pass
+            except check_type.DoesNotExist:
+                continue
+            check.check_timeseries(self.htimeseries.data)
         return self.htimeseries.data
 
 
+# Range checking adds at most one flag to each record. It is handled as a uint8
+# code (an index to _RANGE_CHECK_FLAG_STRINGS) and only converted to a string when
+# it is merged into the "flags" column.
+_RANGE = 1
+_SUSPECT = 2
+_RANGE_CHECK_FLAG_STRINGS = np.array(["", "RANGE", "SUSPECT"])
+
+
+def _get_range_flag_codes_with_numpy(values, low, high, soft_low, soft_high):
+    # Comparisons with NaN are always false, so null values get no flags.
+    result = np.zeros(values.size, dtype=np.uint8)
+    with np.errstate(invalid="ignore"):
+        if soft_low is not None and soft_high is not None:
+            result[(values < soft_low) | (values > soft_high)] = _SUSPECT
+        result[(values < low) | (values > high)] = _RANGE
+    return result
+
+
+def _fill_range_flag_codes(values, low, high, soft_low, soft_high, result):
+    for i in range(values.size):
+        x = values[i]
+        if x != x:  # NaN
+            result[i] = 0
+        elif x < low or x > high:
+            result[i] = _RANGE
+        elif x < soft_low or x > soft_high:
+            result[i] = _SUSPECT
+        else:
+            result[i] = 0
+
+
+def _run_range_flag_codes_loop(fill, values, low, high, soft_low, soft_high):
+    # With unset soft limits we use the hard limits instead, which never results in
+    # SUSPECT; this way the loop needs no None checks and can be compiled by numba.
+    if soft_low is None or soft_high is None:
+        soft_low, soft_high = low, high
+    result = np.empty(values.size, dtype=np.uint8)
+    fill(values, low, high, soft_low, soft_high, result)
+    return result
+
+
+def _get_range_flag_codes_with_loop(values, low, high, soft_low, soft_high):
+    return _run_range_flag_codes_loop(
+        _fill_range_flag_codes, values, low, high, soft_low, soft_high
+    )
+
+
+if numba is None:
+    _get_range_flag_codes = _get_range_flag_codes_with_numpy
+else:
+    # No on-disk cache; it would fail at import time where no cache directory is
+    # writable. Each process compiles the loop once, on first use.
+    _fill_range_flag_codes_compiled = numba.njit(_fill_range_flag_codes)
+
+    def _get_range_flag_codes(values, low, high, soft_low, soft_high):
+        return _run_range_flag_codes_loop(
+            _fill_range_flag_codes_compiled, values, low, high, soft_low, soft_high
+        )
+
+
 class RangeCheck(models.Model):
     checks = models.OneToOneField(Checks, on_delete=models.CASCADE, primary_key=True)
     upper_bound = models.FloatField()
@@ -117,33 +205,29 @@ class RangeCheck(models.Model):
     def __str__(self):
         return _("Range check for {}").format(str(self.checks.timeseries_group))
 
-    def check_timeseries(self):
-        self._do_hard_limits()
-        self._do_soft_limits()
-
-    def _do_hard_limits(self):
-        self._find_out_of_bounds_values(self.lower_bound, self.upper_bound)
-        self._replace_out_of_bounds_values_with_nan()
-        self._add_flag_to_out_of_bounds_values("RANGE")
-
-    def _do_soft_limits(self):
-        self._find_out_of_bounds_values(self.soft_lower_bound, self.soft_upper_bound)
-        self._add_flag_to_out_of_bounds_values("SUSPECT")
-
-    def _find_out_of_bounds_values(self, low, high):
-        timeseries = self.htimeseries.data
-        self.out_of_bounds_mask = ~pd.isnull(timeseries["value"]) & ~timeseries[
-            "value"
-        ].between(low, high)
-
-    def _replace_out_of_bounds_values_with_nan(self):
-        self.htimeseries.data.loc[self.out_of_bounds_mask, "value"] = np.nan
-
-    def _add_flag_to_out_of_bounds_values(self, flag):
-        d = self.htimeseries.data
-        out_of_bounds_with_flags_mask = self.out_of_bounds_mask & (d["flags"] != "")
-        d.loc[out_of_bounds_with_flags_mask, "flags"] += " "
-        d.loc[self.out_of_bounds_mask, "flags"] += flag
+    def check_timeseries(self, data):
+        values = _get_writeable_array(data["value"], dtype=np.float64)
+        flag_codes = _get_range_flag_codes(
+            values,
+            self.lower_bound,
+            self.upper_bound,
+            self.soft_lower_bound,
+            self.soft_upper_bound,
+        )
+        values[flag_codes == _RANGE] = np.nan
+        data["value"] = values
+        self._add_flags(data, flag_codes)
+
+    def _add_flags(self, data, flag_codes):
+        mask = flag_codes != 0
+        flags = _get_writeable_array(data["flags"])
+        existing_flags = flags[mask].astype(str)
+        new_flags = _RANGE_CHECK_FLAG_STRINGS[flag_codes[mask]]
+        suffixes = np.where(
+            existing_flags != "", np.char.add(" ", new_flags), new_flags
+        )
+        flags[mask] = np.char.add(existing_flags, suffixes)
+        data["flags"] = flags
 
 
 class CurveInterpolation(AutoProcess):
@@ -174,15 +258,49 @@ class CurveInterpolation(AutoProcess):
 
     def process_timeseries(self):
         timeseries = self.htimeseries.data
-        for period in self.curveperiod_set.order_by("start_date"):
+        if len(timeseries.index) == 0:
+            return timeseries
+        dates = timeseries.index.values
+        periods = self._get_periods_overlapping(timeseries.index)
+        if len(periods) == 1 and self._period_covers_dates(periods[0], dates):
+            return self._interpolate_entire_timeseries(timeseries, periods[0])
+        values = _get_writeable_array(timeseries["value"], dtype=np.float64)
+        flags = _get_writeable_array(timeseries["flags"])
+        start_dates = np.array([p.start_date for p in periods], dtype="datetime64[D]")
+        end_dates = np.array([p.end_date for p in periods], dtype="datetime64[D]")
+        starts = np.searchsorted(dates, start_dates)
+        ends = np.searchsorted(dates, end_dates, side="right")
+        for period, start, end in zip(periods, starts, ends):
+            if start >= end:
+                continue
             x, y = period._get_curve()
-            start, end = period.start_date, period.end_date
-            values_array = timeseries.loc[start:end, "value"].values
-            new_array = np.interp(values_array, x, y, left=np.nan, right=np.nan)
-            timeseries.loc[start:end, "value"] = new_array
-            timeseries.loc[start:end, "flags"] = ""
+            values[start:end] = np.interp(
+                values[start:end], x, y, left=np.nan, right=np.nan
+            )
+            flags[start:end] = ""
+        timeseries["value"] = values
+        timeseries["flags"] = flags
         return timeseries
 
+    def _period_covers_dates(self, period, dates):
+        start = np.datetime64(period.start_date)
+        end = np.datetime64(period.end_date)
+        return start <= dates[0] and dates[-1] <= end
+
+    def _interpolate_entire_timeseries(self, timeseries, period):
+        # Common case of a single curve period covering everything; no slicing needed
+        x, y = period._get_curve()
+        values = timeseries["value"].to_numpy(dtype=np.float64)
+        timeseries["value"] = np.interp(values, x, y, left=np.nan, right=np.nan)
+        timeseries["flags"] = ""
+        return timeseries
+
+    def _get_periods_overlapping(self, index):
+        periods = self.curveperiod_set.filter(
+            start_date__lte=index[-1].date(), end_date__gte=index[0].date()
+        )
+        return list(periods.order_by("start_date").prefetch_related("curvepoint_set"))
+
 
 class CurvePeriod(models.Model):
     curve_interpolation = models.ForeignKey(
@@ -197,12 +315,11 @@ class CurvePeriod(models.Model):
         )
 
     def _get_curve(self):
-        x = []
-        y = []
-        for point in self.curvepoint_set.filter(curve_period=self).order_by("x"):
-            x.append(point.x)
-            y.append(point.y)
-        return x, y
+        # We sort in Python rather than with order_by() so that points prefetched by
+        # CurveInterpolation.process_timeseries() are used without another query.
+        points = sorted((point.x, point.y) for point in self.curvepoint_set.all())
+        x, y = np.array(points, dtype=np.float64).reshape(-1, 2).T
+        return np.ascontiguousarray(x), np.ascontiguousarray(y)
 
     def set_curve(self, s):
         """Replaces all existing points with ones read from a string.
@@ -211,10 +328,14 @@ class CurvePeriod(models.Model):
         """
 
         s = s.replace("\t", ",")
-        self.curvepoint_set.all().delete()
-        for row in csv.reader(StringIO(s)):
-            x, y = [float(item) for item in row[:2]]
-            CurvePoint.objects.create(curve_period=self, x=x, y=y)
+        points = [
+            CurvePoint(curve_period=self, x=float(row[0]), y=float(row[1]))
+            for row in csv.reader(StringIO(s))
+            if row
+        ]
+        with transaction.atomic():
+            self.curvepoint_set.all().delete()
+            CurvePoint.objects.bulk_create(points)
 
 
 class CurvePoint(models.Model):
@@ -226,6 +347,16 @@ class CurvePoint(models.Model):
         return _("{}: Point ({}, {})").format(str(self.curve_period), self.x, self.y)
 
 
+_RESULTING_TIMESTAMP_OFFSET_RE = re.compile(r"(-?)(\d*)(.*)$")
+
+
+@functools.lru_cache(maxsize=64)
+def _divide_steps(target_step, source_step):
+    return int(
+        pd.Timedelta(target_step) / pd.tseries.frequencies.to_offset(source_step)
+    )
+
+
 class Aggregation(AutoProcess):
     METHOD_CHOICES = [
         ("sum", "Sum"),
@@ -290,17 +421,28 @@ class Aggregation(AutoProcess):
 
     def save(self, force_insert=False, force_update=False, *args, **kwargs):
         self._check_resulting_timestamp_offset()
+        self.__dict__.pop("_offset_timedelta", None)
         super().save(force_insert, force_update, *args, **kwargs)
 
+    @cached_property
+    def _offset_timedelta(self):
+        if not self.resulting_timestamp_offset:
+            return pd.Timedelta(0)
+        sign, number, unit = self._parse_resulting_timestamp_offset()
+        return pd.Timedelta(int(sign + (number or "1")), unit=unit)
+
     def _check_resulting_timestamp_offset(self):
         if not self.resulting_timestamp_offset:
             return
         else:
             self._check_nonempty_resulting_timestamp_offset()
 
+    def _parse_resulting_timestamp_offset(self):
+        m = _RESULTING_TIMESTAMP_OFFSET_RE.match(self.resulting_timestamp_offset)
+        return m.group(1, 2, 3)
+
     def _check_nonempty_resulting_timestamp_offset(self):
-        m = re.match(r"(-?)(\d*)(.*)$", self.resulting_timestamp_offset)
-        sign, number, unit = m.group(1, 2, 3)
+        sign, number, unit = self._parse_resulting_timestamp_offset()
         if unit != "min" or (sign == "-" and number == ""):
             raise IntegrityError(
                 '"{}" is not a valid resulting time step offset.'.format(
@@ -309,6 +451,8 @@ class Aggregation(AutoProcess):
             )
 
     def process_timeseries(self):
+        if len(self.htimeseries.data.index) == 0:
+            return self.htimeseries
         self.source_end_date = self.htimeseries.data.index[-1]
         self._regularize_time_series()
         self._aggregate_time_series()
@@ -344,9 +488,7 @@ class Aggregation(AutoProcess):
         return result
 
     def _divide_target_step_by_source_step(self, source_step, target_step):
-        return int(
-            pd.Timedelta(target_step) / pd.tseries.frequencies.to_offset(source_step)
-        )
+        return _divide_steps(target_step, source_step)
 
     def _trim_last_record_if_not_complete(self):
         # If the very last record of the time series has the "MISS" flag, it means it
@@ -361,9 +503,7 @@ class Aggregation(AutoProcess):
         if len(self.htimeseries.data.index) == 0:
             return False
         last_target_record = self.htimeseries.data.iloc[-1]
-        last_target_record_date = last_target_record.name + pd.Timedelta(
-            self.resulting_timestamp_offset
-        )
+        last_target_record_date = last_target_record.name + self._offset_timedelta
         return (
             "MISS" in last_target_record["flags"]
             and self.source_end_date < last_target_record_date
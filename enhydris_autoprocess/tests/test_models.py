@@ -20,6 +20,8 @@ from enhydris_autoprocess.models import (
     CurvePeriod,
     CurvePoint,
     RangeCheck,
+    _get_range_flag_codes_with_loop,
+    _get_range_flag_codes_with_numpy,
 )
 
 
@@ -254,7 +256,10 @@ class ChecksTestCase(TestCase):
             checks__timeseries_group__variable__descr="Temperature",
         )
         range_check.checks.execute()
-        m.assert_called_once_with()
+        m.assert_called_once_with(mock.ANY)
+        data = m.call_args[0][0]
+        self.assertIsInstance(data, pd.DataFrame)
+        self.assertEqual(list(data.columns), ["value", "flags"])
 
 
 class RangeCheckTestCase(TestCase):
@@ -332,10 +337,46 @@ class RangeCheckProcessTimeseriesTestCase(TestCase):
             soft_lower_bound=3,
             soft_upper_bound=4,
         )
-        self.range_check.checks.htimeseries = HTimeseries(self.source_timeseries)
+        self.range_check.checks.htimeseries = HTimeseries(self.source_timeseries.copy())
         result = self.range_check.checks.process_timeseries()
         pd.testing.assert_frame_equal(result, self.expected_result)
 
+    def test_execute_without_soft_limits(self):
+        self.range_check = mommy.make(
+            RangeCheck,
+            lower_bound=2,
+            upper_bound=5,
+            soft_lower_bound=None,
+            soft_upper_bound=None,
+        )
+        self.range_check.checks.htimeseries = HTimeseries(self.source_timeseries.copy())
+        result = self.range_check.checks.process_timeseries()
+        expected_result = self.expected_result.copy()
+        expected_result["flags"] = [
+            "RANGE",
+            "",
+            "",
+            "",
+            "FLAG1",
+            "FLAG2",
+            "FLAG3 RANGE",
+        ]
+        pd.testing.assert_frame_equal(result, expected_result)
+
+    def test_numpy_and_loop_implementations_agree(self):
+        # Only one of the two implementations is used at runtime, depending on
+        # whether numba is installed, so we check them against each other.
+        values = np.array([1.5, 2.9, 3.1, np.nan, 3.8, 4.9, 7.2, -np.inf, np.inf])
+        for soft_limits in [(3, 4), (None, None), (3, None), (None, 4)]:
+            with self.subTest(soft_limits=soft_limits):
+                expected = _get_range_flag_codes_with_numpy(values, 2, 5, *soft_limits)
+                actual = _get_range_flag_codes_with_loop(values, 2, 5, *soft_limits)
+                np.testing.assert_array_equal(actual, expected)
+        np.testing.assert_array_equal(
+            _get_range_flag_codes_with_loop(values, 2, 5, 3, 4),
+            [1, 2, 0, 0, 0, 2, 1, 1, 1],
+        )
+
 
 class CurveInterpolationTestCase(TestCase):
     def setUp(self):
@@ -519,6 +560,11 @@ class CurvePeriodSetCurveTestCase(TestCase):
         self.assertAlmostEqual(points[2].x, 9)
         self.assertAlmostEqual(points[2].y, 10)
 
+    def test_set_curve_replaces_points_and_ignores_empty_lines(self):
+        self.period.set_curve("5,6\n\n7,8\n")
+        points = CurvePoint.objects.filter(curve_period=self.period).order_by("x")
+        self.assertEqual([(p.x, p.y) for p in points], [(5, 6), (7, 8)])
+
 
 class CurveInterpolationProcessTimeseriesTestCase(TestCase):
     _index = [
@@ -557,10 +603,54 @@ class CurveInterpolationProcessTimeseriesTestCase(TestCase):
         )
         self._setup_period1()
         self._setup_period2()
-        self.curve_interpolation.htimeseries = HTimeseries(self.source_timeseries)
+        self.curve_interpolation.htimeseries = HTimeseries(
+            self.source_timeseries.copy()
+        )
         result = self.curve_interpolation.process_timeseries()
         pd.testing.assert_frame_equal(result, self.expected_result)
 
+    def test_execute_with_single_period(self):
+        result, m = self._execute_with_single_period(
+            dt.date(2019, 5, 1), dt.date(2019, 6, 30)
+        )
+        m.assert_called_once()
+        expected_result = self.expected_result.copy()
+        expected_result["value"] = [np.nan, 105, np.nan, 105, 172.5, np.nan]
+        pd.testing.assert_frame_equal(result, expected_result)
+
+    def test_execute_with_single_period_partly_covering_timeseries(self):
+        result, m = self._execute_with_single_period(
+            dt.date(2019, 5, 1), dt.date(2019, 5, 31)
+        )
+        m.assert_not_called()
+        expected_result = self.source_timeseries.copy()
+        expected_result["value"] = [np.nan, 105, np.nan, 3.1, 4.9, 7.2]
+        expected_result["flags"] = ["", "", "", "", "FLAG1", "FLAG2"]
+        pd.testing.assert_frame_equal(result, expected_result)
+
+    def _execute_with_single_period(self, start_date, end_date):
+        station = mommy.make(Station)
+        self.curve_interpolation = mommy.make(
+            CurveInterpolation,
+            timeseries_group__gentity=station,
+            target_timeseries_group__gentity=station,
+        )
+        period = self._make_period(start_date, end_date)
+        mommy.make(CurvePoint, curve_period=period, x=3, y=100)
+        mommy.make(CurvePoint, curve_period=period, x=4, y=150)
+        mommy.make(CurvePoint, curve_period=period, x=5, y=175)
+        self.curve_interpolation.htimeseries = HTimeseries(
+            self.source_timeseries.copy()
+        )
+        with mock.patch.object(
+            CurveInterpolation,
+            "_interpolate_entire_timeseries",
+            side_effect=CurveInterpolation._interpolate_entire_timeseries,
+            autospec=True,
+        ) as m:
+            result = self.curve_interpolation.process_timeseries()
+        return result, m
+
     def _setup_period1(self):
         period1 = self._make_period(dt.date(2019, 5, 1), dt.date(2019, 5, 31))
         mommy.make(CurvePoint, curve_period=period1, x=3, y=100)
@@ -746,7 +836,7 @@ class AggregationProcessTimeseriesTestCase(TestCase):
         ],
     )
 
-    def _execute(self, max_missing):
+    def _execute(self, max_missing, resulting_timestamp_offset="1min"):
         station = mommy.make(Station)
         self.aggregation = mommy.make(
             Aggregation,
@@ -757,7 +847,7 @@ class AggregationProcessTimeseriesTestCase(TestCase):
             target_time_step="H",
             method="sum",
             max_missing=max_missing,
-            resulting_timestamp_offset="1min",
+            resulting_timestamp_offset=resulting_timestamp_offset,
         )
         self.aggregation.htimeseries = HTimeseries(self.source_timeseries)
         self.aggregation.htimeseries.time_step = "10min"
@@ -778,3 +868,24 @@ class AggregationProcessTimeseriesTestCase(TestCase):
     def test_execute_for_max_missing_too_high(self):
         result = self._execute(max_missing=10000)
         pd.testing.assert_frame_equal(result, self.expected_result_for_max_missing_five)
+
+    def test_execute_with_empty_offset(self):
+        # The last aggregated record (13:00) has the "MISS" flag and ends after the
+        # source, so it must be trimmed even when there is no offset.
+        result = self._execute(max_missing=5, resulting_timestamp_offset="")
+        expected_result = self.expected_result_for_max_missing_five.copy()
+        expected_result.index = [
+            dt.datetime(2019, 5, 21, 10, 0),
+            dt.datetime(2019, 5, 21, 11, 0),
+            dt.datetime(2019, 5, 21, 12, 0),
+        ]
+        pd.testing.assert_frame_equal(result, expected_result)
+
+    def test_execute_with_offset_without_number(self):
+        result = self._execute(max_missing=5, resulting_timestamp_offset="min")
+        pd.testing.assert_frame_equal(result, self.expected_result_for_max_missing_five)
+
+    def test_execute_for_empty_source(self):
+        self.source_timeseries = self.source_timeseries.iloc[:0]
+        result = self._execute(max_missing=0)
+        self.assertEqual(len(result), 0)